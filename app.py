@@ -1,5 +1,35 @@
+import gc
+import importlib.util
+import itertools
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import cachetools
 import gradio as gr
-from transformers import pipeline
+import torch
+from transformers import (
+    AutoConfig,
+    AutoModelForSeq2SeqLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+
+from scoring import similarity
+
+logger = logging.getLogger(__name__)
 
 # -----------------------
 # 1. Language + model config
@@ -13,6 +43,10 @@ LANG_CODES = {
     "Swedish": "sv",
 }
 
+LANG_CHOICES = list(LANG_CODES.keys())
+TONES = ["Neutral", "Formal", "Informal", "Simplified"]
+DOMAINS = ["General", "Business", "Technical", "Casual"]
+
 # Map (src_lang_code, tgt_lang_code) -> MarianMT model
 MODEL_MAP = {
     ("en", "fr"): "Helsinki-NLP/opus-mt-en-fr",
@@ -25,32 +59,719 @@ MODEL_MAP = {
     ("sv", "en"): "Helsinki-NLP/opus-mt-sv-en",
 }
 
-# Lazy-loaded translation pipelines
-_translation_pipelines = {}
+# CPU threads per model call. Gradio's worker threads and our batching threads
+# already run in parallel, so giving every op all cores oversubscribes the CPU.
+NUM_THREADS = max(1, int(os.getenv("POLYGLOT_THREADS", (os.cpu_count() or 2) // 2)))
+torch.set_num_threads(NUM_THREADS)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass  # already set (e.g. module re-executed by Gradio's reload mode)
+
+# Instruction-tuned model for explanations and learning-mode feedback
+EXPLAIN_MODEL = "google/flan-t5-small"
+
+# Micro-batching: concurrent requests for the same language pair that arrive
+# within BATCH_TIMEOUT seconds share a single forward pass.
+MAX_BATCH = 8
+BATCH_TIMEOUT = 0.02  # seconds
+
+# Flan-T5 decodes far longer outputs per request, so it tolerates a longer
+# window for collecting prompts into one batch.
+EXPLAIN_MAX_BATCH = 4
+EXPLAIN_BATCH_TIMEOUT = 0.05  # seconds
+
+# INT8 weights: bitsandbytes on GPU, torch dynamic quantization on CPU.
+# Set POLYGLOT_INT8=0 to load the original checkpoints (BF16/FP16 on GPU, FP32 on CPU).
+USE_INT8 = os.getenv("POLYGLOT_INT8", "1") == "1"
+INT8_CACHE_DIR = Path(os.getenv("POLYGLOT_INT8_CACHE", Path.home() / ".cache" / "polyglot_int8"))
+
+# Opt-in torch.compile of the model forward pass (POLYGLOT_COMPILE=1). The first
+# call per input shape pays the compile cost; later calls reuse the graph.
+USE_COMPILE = os.getenv("POLYGLOT_COMPILE", "0") == "1"
+
+# Inference engine: "transformers" (default), "ctranslate2" or "onnx". The last two
+# convert each checkpoint once (to POLYGLOT_CT2_DIR / POLYGLOT_ONNX_DIR) and run it
+# on CTranslate2's C++ kernels or an optimized ONNX Runtime graph respectively.
+BACKEND = os.getenv("POLYGLOT_BACKEND", "transformers")
+CT2_MODEL_DIR = Path(os.getenv("POLYGLOT_CT2_DIR", Path.home() / ".cache" / "polyglot_ct2"))
+ONNX_MODEL_DIR = Path(os.getenv("POLYGLOT_ONNX_DIR", Path.home() / ".cache" / "polyglot_onnx"))
+
+# Gradio queue: how many events run at once (feeding the micro-batchers) and how
+# many may wait before new requests are turned away.
+CONCURRENCY_LIMIT = int(os.getenv("POLYGLOT_CONCURRENCY", "4"))
+QUEUE_MAX_SIZE = 32
+
+# Pairs loaded in the background at startup (capped at MAX_LOADED_PAIRS so
+# prewarming never evicts its own work). The first three cover every tab's default
+# flow: Smart Translate and Learning Mode (en->fr), Back-translation (en->de->en).
+PREWARM_PAIRS = [("en", "fr"), ("en", "de"), ("de", "en"), ("fr", "en"), ("en", "es"), ("es", "en")]
+
+# Also load Flan-T5 during prewarming ("Explain" is on by default in the UI).
+PREWARM_EXPLAIN = os.getenv("POLYGLOT_PREWARM_EXPLAIN", "1") == "1"
+
+# Stream Flan-T5 explanations/feedback into the UI token by token. Streamers only
+# handle one prompt per generate() call, so streaming bypasses Flan-T5 batching;
+# POLYGLOT_STREAM=0 returns outputs in one piece through the batched path instead.
+STREAM_OUTPUT = os.getenv("POLYGLOT_STREAM", "1") == "1"
+
+# At most this many language pairs stay loaded; the least recently used is evicted.
+MAX_LOADED_PAIRS = max(1, int(os.getenv("POLYGLOT_MAX_PAIRS", "3")))
+
+# Worker pool for overlapping independent steps of a single request
+_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def _quantize_linear_layers(model):
+    """
+    Dynamic INT8 quantization of every nn.Linear except the LM head, which stays
+    in full precision (it is tied to the embeddings and matters most for quality).
+    """
+    qconfig_spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and name != "lm_head"
+    }
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def _load_int8_cpu(model_name: str):
+    """
+    Quantizes a checkpoint for CPU inference, caching the INT8 state dict on disk
+    so later launches skip straight to loading it. Packed INT8 params are not
+    portable across torch versions, so the cache is keyed on the torch version
+    and the checkpoint revision.
+    """
+    config = AutoConfig.from_pretrained(model_name)
+    revision = (getattr(config, "_commit_hash", None) or "local")[:12]
+    cache_name = f"{model_name.replace('/', '--')}-{revision}-torch{torch.__version__}.pt"
+    cache_path = INT8_CACHE_DIR / cache_name
+    if cache_path.exists():
+        model = _quantize_linear_layers(AutoModelForSeq2SeqLM.from_config(config))
+        model.load_state_dict(torch.load(cache_path, weights_only=False))
+    else:
+        model = _quantize_linear_layers(AutoModelForSeq2SeqLM.from_pretrained(model_name))
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write under a temp name first so a killed launch never leaves a
+        # truncated cache file that every later launch would fail to load.
+        tmp_path = cache_path.with_name(f"{cache_name}.{os.getpid()}.tmp")
+        torch.save(model.state_dict(), tmp_path)
+        os.replace(tmp_path, cache_path)
+    return model.eval()
+
+
+def _gpu_dtype(model_name: str):
+    """
+    Half-precision dtype for GPU inference. BF16 is preferred: it keeps FP32's
+    exponent range, which MarianMT embeddings and T5 activations need. T5 is
+    known to overflow in FP16, so it stays in FP32 on GPUs without BF16.
+    """
+    if torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    if AutoConfig.from_pretrained(model_name).model_type == "t5":
+        return torch.float32
+    return torch.float16
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_name: str):
+    """
+    Loads (once per model) the tokenizer, preferring the Rust-backed fast variant.
+    MarianMT ships no fast tokenizer, so those models fall back to SentencePiece.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    # Both MarianMT and Flan-T5 are encoder-decoders: batches only pad the encoder
+    # input, where right padding (masked by the attention mask) is correct.
+    tokenizer.padding_side = "right"
+    return tokenizer
+
+
+def load_seq2seq(model_name: str):
+    """
+    Loads a seq2seq model + tokenizer: INT8 when enabled, otherwise half
+    precision on GPU and FP32 on CPU.
+    """
+    tokenizer = load_tokenizer(model_name)
+    if torch.cuda.is_available():
+        if USE_INT8 and importlib.util.find_spec("bitsandbytes"):
+            model = AutoModelForSeq2SeqLM.from_pretrained(
+                model_name,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=["lm_head"]),
+                device_map="auto",
+            )
+        else:
+            model = AutoModelForSeq2SeqLM.from_pretrained(model_name, torch_dtype=_gpu_dtype(model_name)).to("cuda")
+    elif USE_INT8:
+        model = _load_int8_cpu(model_name)
+    else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+    model.config.use_cache = True
+    if USE_COMPILE:
+        # "reduce-overhead" adds CUDA graphs, which only pay off on GPU.
+        model.compile(mode="reduce-overhead" if torch.cuda.is_available() else "default", dynamic=True)
+    return model, tokenizer
+
+
+def _export_onnx(model_name: str, out_dir: Path, quantize: bool):
+    """
+    Exports a checkpoint to ONNX, fuses attention/LayerNorm/GELU with ORTOptimizer
+    and optionally applies dynamic INT8 quantization. Files are staged in a temp dir
+    so an interrupted export is never mistaken for a finished one.
+    """
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+
+    work_dir = out_dir.with_name(out_dir.name + ".tmp")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    exported = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True)
+    exported.save_pretrained(work_dir / "export")
+    onnx_dir = work_dir / "optimized"
+    ORTOptimizer.from_pretrained(exported).optimize(
+        save_dir=onnx_dir, optimization_config=OptimizationConfig(optimization_level=2)
+    )
+    if quantize:
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        for onnx_path in sorted(onnx_dir.glob("*.onnx")):
+            quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name=onnx_path.name)
+            quantizer.quantize(save_dir=work_dir / "quantized", quantization_config=qconfig)
+        onnx_dir = work_dir / "quantized"
+
+    # Restore the default file names so ORTModelForSeq2SeqLM finds them without hints.
+    final_dir = work_dir / "final"
+    final_dir.mkdir()
+    for onnx_path in onnx_dir.glob("*.onnx"):
+        name = onnx_path.name.replace("_optimized", "").replace("_quantized", "")
+        shutil.move(onnx_path, final_dir / name)
+    for config_path in (work_dir / "export").glob("*.json"):
+        shutil.copy(config_path, final_dir / config_path.name)
+    final_dir.rename(out_dir)
+    shutil.rmtree(work_dir)
+
+
+def load_onnx_seq2seq(model_name: str):
+    """
+    Loads the cached ONNX export of a checkpoint (exporting it on first use)
+    into ONNX Runtime with every graph optimization enabled.
+    """
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+    on_gpu = torch.cuda.is_available()
+    # ONNX Runtime's dynamic INT8 kernels are CPU-only.
+    quantize = USE_INT8 and not on_gpu
+    model_dir = ONNX_MODEL_DIR / (model_name.replace("/", "--") + ("-int8" if quantize else ""))
+    if not model_dir.exists():
+        _export_onnx(model_name, model_dir, quantize)
 
-# One small LLM for explanations / feedback
-explain_llm = pipeline("text2text-generation", model="google/flan-t5-small")
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = NUM_THREADS
+    session_options.inter_op_num_threads = 1
+    model = ORTModelForSeq2SeqLM.from_pretrained(
+        model_dir,
+        provider="CUDAExecutionProvider" if on_gpu else "CPUExecutionProvider",
+        session_options=session_options,
+    )
+    return model, load_tokenizer(model_name)
+
+
+class _StopOnEvent(StoppingCriteria):
+    """
+    Ends generate() as soon as the event is set, e.g. when the UI stops reading.
+    """
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class Seq2SeqGenerator:
+    """
+    Tokenizer + model pair driven through model.generate directly, skipping the
+    per-call preprocessing of transformers pipelines. Works for both PyTorch and
+    ONNX Runtime (optimum) models.
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        # Rounding padded lengths up to a multiple of 8 suits tensor cores and
+        # keeps the number of distinct shapes torch.compile sees small.
+        self._pad_multiple = 8 if self.model.device.type == "cuda" or USE_COMPILE else None
+
+    def _pad(self, encodings: list):
+        """
+        Pads a batch of encodings into one tensor batch on the model's device.
+        """
+        return self.tokenizer.pad(
+            encodings, return_tensors="pt", pad_to_multiple_of=self._pad_multiple
+        ).to(self.model.device)
+
+    def encode(self, text: str):
+        """
+        Tokenizes one input (unpadded), so callers can do it off the model thread.
+        """
+        return self.tokenizer(text, truncation=True, max_length=512)
+
+    def generate(self, texts: list[str], **gen_kwargs) -> list[str]:
+        return self.generate_encoded([self.encode(text) for text in texts], **gen_kwargs)
+
+    def generate_encoded(self, encodings: list, **gen_kwargs) -> list[str]:
+        inputs = self._pad(encodings)
+        with torch.inference_mode():
+            output_ids = self.model.generate(**inputs, **gen_kwargs)
+        return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+    def stream(self, text: str, **gen_kwargs):
+        """
+        Yields decoded text chunks while generate() runs in a background thread.
+        If the consumer stops early (new click, client disconnect), generation is
+        cancelled instead of decoding the rest for nobody.
+        """
+        inputs = self._pad([self.encode(text)])
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cancelled = threading.Event()
+        stopping_criteria = StoppingCriteriaList([_StopOnEvent(cancelled)])
+        errors = []
+
+        def run():
+            try:
+                with torch.inference_mode():
+                    self.model.generate(
+                        **inputs, **gen_kwargs, streamer=streamer, stopping_criteria=stopping_criteria
+                    )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()  # unblock the consumer below
+
+        threading.Thread(target=run, daemon=True).start()
+        try:
+            yield from streamer
+        finally:
+            cancelled.set()
+        if errors:
+            raise errors[0]
+
+
+class CTranslate2Generator:
+    """
+    Same interface as Seq2SeqGenerator, backed by a CTranslate2 Translator. The
+    HF tokenizer is kept for encoding/decoding; CTranslate2 consumes token strings.
+    """
+
+    def __init__(self, model_name: str):
+        import ctranslate2
+
+        self.tokenizer = load_tokenizer(model_name)
+        model_dir = CT2_MODEL_DIR / (model_name.replace("/", "--") + ("-int8" if USE_INT8 else ""))
+        if not model_dir.exists():
+            # Convert into a temp dir and rename, so an interrupted conversion is
+            # never mistaken for a finished one (convert() won't overwrite it).
+            work_dir = model_dir.with_name(model_dir.name + ".tmp")
+            shutil.rmtree(work_dir, ignore_errors=True)
+            converter = ctranslate2.converters.TransformersConverter(model_name)
+            converter.convert(str(work_dir), quantization="int8" if USE_INT8 else None)
+            work_dir.rename(model_dir)
+
+        if torch.cuda.is_available():
+            device = "cuda"
+            compute_type = "int8_float16" if USE_INT8 else str(_gpu_dtype(model_name)).removeprefix("torch.")
+        else:
+            device = "cpu"
+            compute_type = "int8" if USE_INT8 else "float32"
+        self.translator = ctranslate2.Translator(
+            str(model_dir),
+            device=device,
+            compute_type=compute_type,
+            inter_threads=1,
+            intra_threads=NUM_THREADS,
+        )
+
+    def encode(self, text: str):
+        return self.tokenizer(text, truncation=True, max_length=512)
+
+    def generate(self, texts: list[str], **gen_kwargs) -> list[str]:
+        return self.generate_encoded([self.encode(text) for text in texts], **gen_kwargs)
+
+    def generate_encoded(self, encodings: list, **gen_kwargs) -> list[str]:
+        tokens = [self.tokenizer.convert_ids_to_tokens(encoding["input_ids"]) for encoding in encodings]
+        max_length = gen_kwargs.get("max_new_tokens") or gen_kwargs.get("max_length", 512)
+        results = self.translator.translate_batch(
+            tokens,
+            beam_size=gen_kwargs.get("num_beams", 1),
+            max_decoding_length=max_length,
+        )
+        return [
+            self.tokenizer.decode(
+                self.tokenizer.convert_tokens_to_ids(result.hypotheses[0]), skip_special_tokens=True
+            )
+            for result in results
+        ]
+
+    def stream(self, text: str, **gen_kwargs):
+        # No incremental decoding here; emit the finished output as one chunk.
+        yield self.generate([text], **gen_kwargs)[0]
+
+
+def load_generator(model_name: str):
+    """
+    Builds the generator for a checkpoint on the configured BACKEND.
+    """
+    if BACKEND == "ctranslate2":
+        return CTranslate2Generator(model_name)
+    if BACKEND == "onnx":
+        return Seq2SeqGenerator(*load_onnx_seq2seq(model_name))
+    return Seq2SeqGenerator(*load_seq2seq(model_name))
+
+
+def _decoding_kwargs(encodings, num_beams: int) -> dict:
+    """
+    Generation settings for a batch: greedy unless beams are requested, and an
+    output budget proportional to the longest input rather than a flat 512.
+    """
+    longest = max(len(encoding["input_ids"]) for encoding in encodings)
+    kwargs = dict(max_length=min(512, 2 * longest + 8), num_beams=num_beams, do_sample=False)
+    if num_beams > 1:
+        kwargs["early_stopping"] = True
+    return kwargs
+
+
+def _free_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelUnloadedError(RuntimeError):
+    """
+    Raised when a request reaches a batcher whose model was evicted after the
+    caller looked it up; fetching the pipeline again loads a fresh one.
+    """
+
+
+class _MicroBatcher(ABC):
+    """
+    Wraps a generator with a queue + worker thread that coalesces concurrent
+    calls into batched generate calls. Each request carries a hashable options
+    key; only requests with equal options share a call. Subclasses turn the
+    options into generate() kwargs.
+    """
+
+    def __init__(self, generator, max_batch: int, batch_timeout: float):
+        self.generator = generator
+        self.max_batch = max_batch
+        self.batch_timeout = batch_timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @abstractmethod
+    def _generation_kwargs(self, encodings, options) -> dict:
+        """
+        Turns a group's options key into generate() kwargs.
+        """
+
+    def submit(self, text: str, options) -> str:
+        with self._lock:
+            generator = self.generator
+        if generator is None:
+            raise ModelUnloadedError("This model was unloaded while the request was in flight.")
+        # Tokenize in the caller's thread so the worker only runs the model.
+        encoding = generator.encode(text)
+        done = threading.Event()
+        slot = {}
+        with self._lock:
+            if self._closed:
+                # Evicted while this caller still held a reference: serve it directly.
+                return generator.generate_encoded([encoding], **self._generation_kwargs([encoding], options))[0]
+            self._queue.put((encoding, options, done, slot))
+        done.wait()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["result"]
+
+    def close(self):
+        """
+        Stops the worker once the requests already queued have been served.
+        """
+        with self._lock:
+            self._closed = True
+            self._queue.put(None)
+
+    def join(self):
+        """
+        Waits for a closed worker to finish and release its model.
+        """
+        self._worker.join()
+
+    def _collect(self):
+        # Block for the first request, then keep draining until the batch is
+        # full or the timeout window closes. None (from close()) ends the batch.
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.max_batch and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch[-1] is None:
+                self._process(batch[:-1])
+                break
+            self._process(batch)
+        # Drop the model so eviction actually releases its memory.
+        with self._lock:
+            self.generator = None
+        _free_memory()
+
+    def _process(self, batch):
+        groups = defaultdict(list)
+        for item in batch:
+            groups[item[1]].append(item)
+        for options, items in groups.items():
+            self._generate_group(items, options)
+
+    def _generate_group(self, items, options):
+        encodings = [encoding for encoding, _, _, _ in items]
+        try:
+            outputs = self.generator.generate_encoded(encodings, **self._generation_kwargs(encodings, options))
+            for (_, _, _, slot), out in zip(items, outputs):
+                slot["result"] = out
+        except Exception as e:
+            # Hand the failure back to every caller waiting on this batch.
+            for _, _, _, slot in items:
+                slot["error"] = e
+        for _, _, done, _ in items:
+            done.set()
+
+
+class BatchedTranslator(_MicroBatcher):
+    """
+    Micro-batches translation requests for one language pair, grouped by beam width.
+    """
+
+    def __init__(self, generator, max_batch: int = MAX_BATCH, batch_timeout: float = BATCH_TIMEOUT):
+        super().__init__(generator, max_batch, batch_timeout)
+
+    def __call__(self, text: str, num_beams: int = 1) -> str:
+        return self.submit(text, num_beams)
+
+    def _generation_kwargs(self, encodings, num_beams: int) -> dict:
+        return _decoding_kwargs(encodings, num_beams)
+
+
+class BatchedGenerator(_MicroBatcher):
+    """
+    Micro-batches free-form prompts (explanations, feedback); prompts sent with
+    the same generate() kwargs share a call.
+    """
+
+    def __init__(
+        self, generator, max_batch: int = EXPLAIN_MAX_BATCH, batch_timeout: float = EXPLAIN_BATCH_TIMEOUT
+    ):
+        super().__init__(generator, max_batch, batch_timeout)
+
+    def __call__(self, prompt: str, **gen_kwargs) -> str:
+        return self.submit(prompt, tuple(sorted(gen_kwargs.items())))
+
+    def stream(self, prompt: str, **gen_kwargs):
+        """
+        Streams one prompt directly, bypassing the batching queue: streamers only
+        support a batch of one.
+        """
+        yield from self.generator.stream(prompt, **gen_kwargs)
+
+    def _generation_kwargs(self, encodings, options) -> dict:
+        return dict(options)
+
+
+# One small LLM for explanations / feedback, loaded on first use (double-checked
+# lock, like the translation cache) so importing the app stays fast and users who
+# never ask for explanations never pay for it.
+_explain_llm = None
+_explain_lock = threading.Lock()
+
+
+def get_explain_llm() -> BatchedGenerator:
+    """
+    Returns the shared Flan-T5 BatchedGenerator, loading it lazily.
+    """
+    global _explain_llm
+    if _explain_llm is None:
+        with _explain_lock:
+            if _explain_llm is None:
+                _explain_llm = BatchedGenerator(load_generator(EXPLAIN_MODEL))
+    return _explain_llm
+
+
+class _TranslatorCache(cachetools.LRUCache):
+    """
+    LRU cache of BatchedTranslators that shuts down whichever one it evicts.
+    """
+
+    def popitem(self):
+        key, translator = super().popitem()
+        translator.close()
+        return key, translator
+
+
+# Lazy-loaded translation pipelines (one BatchedTranslator per language pair).
+# _pipelines_lock guards the cache and the count of loads in flight; a per-pair
+# lock lets different pairs load in parallel while stopping the same pair from
+# loading twice.
+_translation_pipelines = _TranslatorCache(maxsize=MAX_LOADED_PAIRS)
+_pipelines_lock = threading.Condition()
+_pair_locks = defaultdict(threading.Lock)
+_loads_in_flight = 0
+
+
+def _reserve_slot():
+    """
+    Makes room for one more model before it loads, so resident pairs plus loads
+    in flight never exceed MAX_LOADED_PAIRS. When every slot is taken by another
+    load, waits for it to finish. Caller holds _pipelines_lock; returns the
+    evicted translators.
+    """
+    global _loads_in_flight
+    evicted = []
+    while len(_translation_pipelines) + _loads_in_flight >= _translation_pipelines.maxsize:
+        if len(_translation_pipelines):
+            evicted.append(_translation_pipelines.popitem()[1])
+        else:
+            _pipelines_lock.wait()
+    _loads_in_flight += 1
+    return evicted
 
 
 def get_translation_pipeline(src_code: str, tgt_code: str):
     """
-    Returns a transformers pipeline for a given language pair, loading it lazily.
+    Returns a BatchedTranslator for a given language pair, loading it lazily.
     """
+    global _loads_in_flight
     key = (src_code, tgt_code)
     if key not in MODEL_MAP:
         raise ValueError(f"Language pair {src_code}->{tgt_code} not supported yet.")
-    if key not in _translation_pipelines:
-        model_name = MODEL_MAP[key]
-        task = f"translation_{src_code}_to_{tgt_code}"
-        _translation_pipelines[key] = pipeline(task, model=model_name)
-    return _translation_pipelines[key]
+    with _pipelines_lock:
+        translator = _translation_pipelines.get(key)
+        pair_lock = _pair_locks[key]
+    if translator is not None:
+        return translator
+    with pair_lock:
+        with _pipelines_lock:
+            translator = _translation_pipelines.get(key)
+        if translator is not None:
+            return translator
+
+        # Fail fast on an unreachable checkpoint (e.g. no network) before a
+        # working pair is evicted to make room for it.
+        AutoConfig.from_pretrained(MODEL_MAP[key])
+        with _pipelines_lock:
+            evicted = _reserve_slot()
+        for old in evicted:
+            old.join()  # its worker drops the model and frees memory on exit
+        try:
+            translator = BatchedTranslator(load_generator(MODEL_MAP[key]))
+        finally:
+            with _pipelines_lock:
+                _loads_in_flight -= 1
+                if translator is not None:
+                    _translation_pipelines[key] = translator
+                _pipelines_lock.notify_all()
+    return translator
+
+
+def prewarm_models():
+    """
+    Loads the most common pairs and runs a tiny translation through each, so the
+    first real click doesn't pay for model loading (or torch.compile).
+    """
+    # A failed download only skips that model; the rest still warm up.
+    for src_code, tgt_code in PREWARM_PAIRS[:MAX_LOADED_PAIRS]:
+        try:
+            get_translation_pipeline(src_code, tgt_code)("hello")
+        except Exception:
+            logger.exception("Prewarming %s->%s failed", src_code, tgt_code)
+    if PREWARM_EXPLAIN:
+        try:
+            get_explain_llm()
+        except Exception:
+            logger.exception("Prewarming %s failed", EXPLAIN_MODEL)
 
 
 # -----------------------
 # 2. Core translation logic
 # -----------------------
 
-def _apply_style_hints(text: str, tone: str, domain: str, tgt_lang: str) -> str:
+@dataclass(frozen=True, slots=True)
+class TranslationRequest:
+    """
+    One request from the UI, validated once at the boundary. Frozen, so it can
+    key the translation cache directly.
+    """
+
+    text: str
+    src_lang: str
+    tgt_lang: str
+    tone: str = "Neutral"
+    domain: str = "General"
+    beams: int = 1
+
+    @classmethod
+    def from_ui(cls, text, src_lang, tgt_lang, tone="Neutral", domain="General", beams=1):
+        return cls((text or "").strip(), src_lang, tgt_lang, tone, domain, int(beams))
+
+
+# Prompt templates, filled with str.format
+EXPLAIN_PROMPT = (
+    "You are a helpful language teacher. "
+    "Explain this translation to a learner in simple terms. "
+    "Mention important word choices, tone, and any interesting grammar.\n\n"
+    "Source language: {src_lang}\n"
+    "Target language: {tgt_lang}\n\n"
+    "Original text:\n{src_text}\n\n"
+    "Translation:\n{translated_text}\n\n"
+    "Explanation (in English, 1–2 short paragraphs):"
+)
+
+FEEDBACK_PROMPT = (
+    "You are a friendly language teacher. Compare the student's translation to the model translation. "
+    "Explain what is good, what could be improved, and give 2–4 concrete suggestions. "
+    "Be encouraging, not harsh.\n\n"
+    "Source language: {src_lang}\n"
+    "Target language: {tgt_lang}\n\n"
+    "Original text:\n{src_text}\n\n"
+    "Student's translation:\n{user_translation}\n\n"
+    "Model's translation:\n{model_translation}\n\n"
+    "Feedback (in English, short and structured):"
+)
+
+FAST_TRANSLATE_PROMPT = (
+    "Translate the following {src_lang} text to {tgt_lang} ({tone} tone, {domain} context).\n"
+    "Text: {text}\n"
+    "Translation:"
+)
+
+FAST_EXPLAIN_PROMPT = (
+    "Translate the following {src_lang} text to {tgt_lang} ({tone} tone, {domain} context). "
+    "Then explain the translation to a learner in simple terms.\n"
+    "Text: {text}\n"
+    "Answer format:\nTranslation: ...\nExplanation: ..."
+)
+
+
+def _build_style_prefix(tone: str, domain: str, tgt_lang: str) -> str:
     """
     MarianMT isn't instruction-tuned, but we can still stuff a hint into the input.
     It won't be perfect, but conceptually shows tone/domain-aware translation.
@@ -64,120 +785,176 @@ def _apply_style_hints(text: str, tone: str, domain: str, tgt_lang: str) -> str:
     if hints:
         hint_str = ", ".join(hints)
         # Just prepend some natural-language hints in English.
-        styled = f"[{hint_str} in {tgt_lang}] {text}"
-        return styled
-    return text
+        return f"[{hint_str} in {tgt_lang}] "
+    return ""
+
 
+# Every (tone, domain, tgt_lang) the UI can send, precomputed at import time
+STYLE_PREFIX = {
+    (tone, domain, tgt_lang): _build_style_prefix(tone, domain, tgt_lang)
+    for tone, domain, tgt_lang in itertools.product(TONES, DOMAINS, LANG_CHOICES)
+}
 
-def translate_text(text: str, src_lang: str, tgt_lang: str, tone: str, domain: str):
+
+def _apply_style_hints(text: str, tone: str, domain: str, tgt_lang: str) -> str:
+    key = (tone, domain, tgt_lang)
+    prefix = STYLE_PREFIX[key] if key in STYLE_PREFIX else _build_style_prefix(*key)
+    return prefix + text if prefix else text
+
+
+def translate_text(req: TranslationRequest) -> str:
     """
-    Main translation function for the UI.
+    Main translation function for the UI. Decodes greedily unless req.beams > 1.
     """
-    text = (text or "").strip()
-    if not text:
+    if not req.text:
         return "Please enter some text to translate."
 
-    if src_lang == tgt_lang:
-        return text  # trivial case
+    if req.src_lang == req.tgt_lang:
+        return req.text  # trivial case
+
+    src_code = LANG_CODES[req.src_lang]
+    tgt_code = LANG_CODES[req.tgt_lang]
 
-    src_code = LANG_CODES[src_lang]
-    tgt_code = LANG_CODES[tgt_lang]
+    styled_input = _apply_style_hints(req.text, req.tone, req.domain, req.tgt_lang)
 
-    try:
-        translator = get_translation_pipeline(src_code, tgt_code)
-    except ValueError as e:
-        return str(e)
+    while True:
+        try:
+            translator = get_translation_pipeline(src_code, tgt_code)
+        except ValueError as e:
+            return str(e)
+        try:
+            translated = translator(styled_input, num_beams=req.beams)
+        except ModelUnloadedError:
+            continue  # evicted between lookup and submit: fetch (and reload) it again
+        return translated.strip()
 
-    styled_input = _apply_style_hints(text, tone, domain, tgt_lang)
 
-    out = translator(styled_input, max_length=512)
-    translated = out[0]["translation_text"]
-    return translated.strip()
+# Memoized translate_text for handlers that re-submit the same request, e.g.
+# repeated learning-mode feedback or toggling "Explain" in the Smart Translate tab.
+_translate_cached = lru_cache(maxsize=256)(translate_text)
 
 
-def back_translate(text: str, src_lang: str, tgt_lang: str, tone: str, domain: str):
+def back_translate(req: TranslationRequest):
     """
     Translate from src -> tgt, then back tgt -> src to check meaning preservation.
+    Also returns a 0–1 similarity score between the original and the back-translation.
     """
-    text = (text or "").strip()
-    if not text:
-        return "Please enter some text to translate.", ""
+    if not req.text:
+        return "Please enter some text to translate.", "", None
+
+    if req.src_lang == req.tgt_lang:
+        return req.text, req.text, 1.0
 
-    if src_lang == tgt_lang:
-        return text, text
+    # Both directions need a model; otherwise there is nothing to score.
+    src_code = LANG_CODES[req.src_lang]
+    tgt_code = LANG_CODES[req.tgt_lang]
+    for pair in ((src_code, tgt_code), (tgt_code, src_code)):
+        if pair not in MODEL_MAP:
+            return f"Language pair {pair[0]}->{pair[1]} not supported yet.", "", None
 
-    # First translation: src -> tgt
-    forward = translate_text(text, src_lang, tgt_lang, tone, domain)
+    # First translation: src -> tgt, while the reverse model loads in parallel
+    forward_future = _executor.submit(translate_text, req)
+    get_translation_pipeline(tgt_code, src_code)
+    forward = forward_future.result()
     # Back translation: tgt -> src (no style hints on the way back)
-    backward = translate_text(forward, tgt_lang, src_lang, "Neutral", "General")
+    backward = translate_text(TranslationRequest(forward, req.tgt_lang, req.src_lang))
 
-    return forward, backward
+    return forward, backward, round(similarity(req.text, backward), 3)
 
 
-def explain_translation(src_text: str, translated_text: str, src_lang: str, tgt_lang: str):
+def _run_explain_llm(prompt: str, max_new_tokens: int):
     """
-    Use Flan-T5 to explain the translation in simple terms.
+    Yields the growing Flan-T5 output, or the whole output once when streaming is off.
+    """
+    explain_llm = get_explain_llm()
+    if not STREAM_OUTPUT:
+        yield explain_llm(prompt, max_new_tokens=max_new_tokens, temperature=0.4).strip()
+        return
+    text = ""
+    for chunk in explain_llm.stream(prompt, max_new_tokens=max_new_tokens, temperature=0.4):
+        text += chunk
+        yield text.strip()
+
+
+def explain_translation(req: TranslationRequest, translated_text: str):
+    """
+    Use Flan-T5 to explain the translation in simple terms (yields partial text).
     """
-    src_text = (src_text or "").strip()
     translated_text = (translated_text or "").strip()
 
-    if not src_text or not translated_text:
-        return "Provide both the original text and the translation to get an explanation."
-
-    prompt = (
-        "You are a helpful language teacher. "
-        "Explain this translation to a learner in simple terms. "
-        "Mention important word choices, tone, and any interesting grammar.\n\n"
-        f"Source language: {src_lang}\n"
-        f"Target language: {tgt_lang}\n\n"
-        f"Original text:\n{src_text}\n\n"
-        f"Translation:\n{translated_text}\n\n"
-        "Explanation (in English, 1–2 short paragraphs):"
+    if not req.text or not translated_text:
+        yield "Provide both the original text and the translation to get an explanation."
+        return
+
+    prompt = EXPLAIN_PROMPT.format(
+        src_lang=req.src_lang, tgt_lang=req.tgt_lang, src_text=req.text, translated_text=translated_text
     )
+    yield from _run_explain_llm(prompt, max_new_tokens=256)
 
-    out = explain_llm(prompt, max_new_tokens=256, temperature=0.4)
-    return out[0]["generated_text"].strip()
 
+def _parse_fused_output(text: str):
+    """
+    Splits "Translation: ... Explanation: ..." output into its two parts. Works on
+    partial (streamed) output and when the model drops the labels.
+    """
+    translation, _, explanation = text.partition("Explanation:")
+    translation = translation.strip().removeprefix("Translation:")
+    return translation.strip(), explanation.strip()
 
-def learning_mode_feedback(src_text: str, user_translation: str, src_lang: str, tgt_lang: str):
+
+def fast_translate_and_explain(req: TranslationRequest, do_explain: bool):
     """
-    Compare user's translation to model translation and give feedback.
+    Fast mode: Flan-T5 alone translates (and optionally explains) in one generate
+    call, skipping MarianMT. Quicker on CPU, but weaker on non-English pairs.
+    Yields (translation, explanation) as the output grows.
+    """
+    if not req.text:
+        yield "Please enter some text to translate.", ""
+        return
+
+    if req.src_lang == req.tgt_lang:
+        yield req.text, ""
+        return
+
+    template = FAST_EXPLAIN_PROMPT if do_explain else FAST_TRANSLATE_PROMPT
+    prompt = template.format(
+        src_lang=req.src_lang, tgt_lang=req.tgt_lang, tone=req.tone, domain=req.domain, text=req.text
+    )
+    for output in _run_explain_llm(prompt, max_new_tokens=320):
+        translation, explanation = _parse_fused_output(output)
+        yield translation, explanation
+
+
+def learning_mode_feedback(req: TranslationRequest, user_translation: str):
+    """
+    Compare user's translation to model translation and give feedback (yields partial text).
     """
-    src_text = (src_text or "").strip()
     user_translation = (user_translation or "").strip()
 
-    if not src_text or not user_translation:
-        return "Please provide both the original text and your translation."
+    if not req.text or not user_translation:
+        yield "Please provide both the original text and your translation."
+        return
 
     # Model's best guess (neutral, general)
-    model_translation = translate_text(src_text, src_lang, tgt_lang, "Neutral", "General")
-
-    prompt = (
-        "You are a friendly language teacher. Compare the student's translation to the model translation. "
-        "Explain what is good, what could be improved, and give 2–4 concrete suggestions. "
-        "Be encouraging, not harsh.\n\n"
-        f"Source language: {src_lang}\n"
-        f"Target language: {tgt_lang}\n\n"
-        f"Original text:\n{src_text}\n\n"
-        f"Student's translation:\n{user_translation}\n\n"
-        f"Model's translation:\n{model_translation}\n\n"
-        "Feedback (in English, short and structured):"
-    )
+    model_translation = _translate_cached(TranslationRequest(req.text, req.src_lang, req.tgt_lang))
 
-    out = explain_llm(prompt, max_new_tokens=320, temperature=0.4)
-    feedback = out[0]["generated_text"].strip()
+    prompt = FEEDBACK_PROMPT.format(
+        src_lang=req.src_lang,
+        tgt_lang=req.tgt_lang,
+        src_text=req.text,
+        user_translation=user_translation,
+        model_translation=model_translation,
+    )
 
-    return f"**Model translation:**\n\n{model_translation}\n\n---\n\n**Feedback:**\n\n{feedback}"
+    header = f"**Model translation:**\n\n{model_translation}\n\n---\n\n**Feedback:**\n\n"
+    for feedback in _run_explain_llm(prompt, max_new_tokens=320):
+        yield header + feedback
 
 
 # -----------------------
 # 3. Gradio UI
 # -----------------------
 
-LANG_CHOICES = list(LANG_CODES.keys())
-TONES = ["Neutral", "Formal", "Informal", "Simplified"]
-DOMAINS = ["General", "Business", "Technical", "Casual"]
-
 with gr.Blocks(title="PolyglotLab – Smart Translator & Learning Studio") as demo:
     gr.Markdown(
         """
@@ -208,24 +985,38 @@ with gr.Blocks(title="PolyglotLab – Smart Translator & Learning Studio") as de
             tone_in = gr.Dropdown(TONES, value="Neutral", label="Tone hint")
             domain_in = gr.Dropdown(DOMAINS, value="General", label="Domain / context")
 
-        explain_checkbox = gr.Checkbox(value=True, label="Explain the translation")
+        beams_in = gr.Slider(1, 5, value=1, step=1, label="Beam search width (1 = fast greedy decoding)")
+
+        with gr.Row():
+            explain_checkbox = gr.Checkbox(value=True, label="Explain the translation")
+            fast_mode_checkbox = gr.Checkbox(
+                value=False, label="Fast mode (Flan-T5 translates + explains in one pass, lower quality)"
+            )
 
         translate_btn = gr.Button("Translate ✨")
 
         translated_out = gr.Textbox(label="Translation", lines=4)
         explanation_out = gr.Markdown(label="Explanation")
 
-        def translate_and_explain(text, src, tgt, tone, domain, do_explain):
-            translation = translate_text(text, src, tgt, tone, domain)
+        def translate_and_explain(text, src, tgt, tone, domain, beams, do_explain, fast_mode):
+            req = TranslationRequest.from_ui(text, src, tgt, tone, domain, beams)
+            if fast_mode:
+                yield from fast_translate_and_explain(req, do_explain)
+                return
+            translation = _translate_cached(req)
             if not do_explain:
-                return translation, ""
-            exp = explain_translation(text, translation, src, tgt)
-            return translation, exp
+                yield translation, ""
+                return
+            for exp in explain_translation(req, translation):
+                yield translation, exp
 
         translate_btn.click(
             fn=translate_and_explain,
-            inputs=[text_in, src_lang_in, tgt_lang_in, tone_in, domain_in, explain_checkbox],
+            inputs=[
+                text_in, src_lang_in, tgt_lang_in, tone_in, domain_in, beams_in, explain_checkbox, fast_mode_checkbox
+            ],
             outputs=[translated_out, explanation_out],
+            api_name="translate",
         )
 
     with gr.Tab("Back-translation Check"):
@@ -248,11 +1039,16 @@ with gr.Blocks(title="PolyglotLab – Smart Translator & Learning Studio") as de
 
         bt_forward_out = gr.Textbox(label="Forward translation (src → tgt)", lines=4)
         bt_backward_out = gr.Textbox(label="Back-translation (tgt → src)", lines=4)
+        bt_score_out = gr.Number(label="Meaning preservation (similarity to the original, 0–1)")
+
+        def run_back_translation(text, src, tgt, tone, domain):
+            return back_translate(TranslationRequest.from_ui(text, src, tgt, tone, domain))
 
         bt_btn.click(
-            fn=back_translate,
+            fn=run_back_translation,
             inputs=[bt_text_in, bt_src_lang, bt_tgt_lang, bt_tone_in, bt_domain_in],
-            outputs=[bt_forward_out, bt_backward_out],
+            outputs=[bt_forward_out, bt_backward_out, bt_score_out],
+            api_name="back_translate",
         )
 
     with gr.Tab("Learning Mode"):
@@ -281,11 +1077,16 @@ with gr.Blocks(title="PolyglotLab – Smart Translator & Learning Studio") as de
         lm_btn = gr.Button("Get feedback 🧑‍🏫")
         lm_feedback_out = gr.Markdown(label="Feedback")
 
+        def run_learning_feedback(src_text, user_translation, src, tgt):
+            yield from learning_mode_feedback(TranslationRequest.from_ui(src_text, src, tgt), user_translation)
+
         lm_btn.click(
-            fn=learning_mode_feedback,
+            fn=run_learning_feedback,
             inputs=[lm_src_text, lm_user_translation, lm_src_lang, lm_tgt_lang],
             outputs=lm_feedback_out,
+            api_name="learning_feedback",
         )
 
 if __name__ == "__main__":
-    demo.launch()
+    threading.Thread(target=prewarm_models, daemon=True).start()
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT, max_size=QUEUE_MAX_SIZE).launch()